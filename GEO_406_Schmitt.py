@@ -1,11 +1,13 @@
 import dash
+import diskcache
+import json
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objs as go
 import pyproj
 import sqlite3
 import bcrypt
-from dash import dcc, html, Input, Output, State
+import precompute
+from dash import dcc, html, Input, Output, State, DiskcacheManager
 from flask import Flask, render_template, request, redirect, url_for, session
 from dash import dash_table
 
@@ -57,12 +59,19 @@ cursor.execute('''
 ''')
 conn.commit()
 
+# Create the result store through the worker, so both use the same database path
+precompute.init_cache()
+
 # Admin Username and Password
 admin_name = 'admin'
 admin_password = 'admin'
 
+# Long callbacks (e.g. exports) run as background tasks, so requests don't time out
+background_callback_manager = DiskcacheManager(diskcache.Cache('./callback_cache'))
+
 # Dash App initialization
-dash_app = dash.Dash(__name__, server=server, url_base_pathname='/dash/')
+dash_app = dash.Dash(__name__, server=server, url_base_pathname='/dash/',
+                     background_callback_manager=background_callback_manager)
 
 # Dash App Layout definition
 dash_app.layout = html.Div([
@@ -81,6 +90,7 @@ dash_app.layout = html.Div([
     ),
     html.Div([
         html.Button("Download CSV", id="btn_csv"),
+        html.Progress(id="download-progress", value='0', max='3'),
         dcc.Download(id="download-dataframe-csv"),
     ]),
     dcc.Graph(id='plot'),
@@ -301,25 +311,15 @@ def update_plot(clickData, data_type):
     if clickData is not None:
         selected_station_id = clickData['points'][0]['customdata'][0]
         station_name = clickData['points'][0]['hovertext']
+        # Count the request in the background, so the plot doesn't wait for the database lock
+        precompute.executor.submit(precompute.count_request, selected_station_id, data_type)
 
-        # Connect to the SQLite database
-        connection_pegel = sqlite3.connect('Geo_406_Schmitt.db')
-
-        query_pegel = (f"SELECT messstelle_nr, zeit, {data_type} FROM pegel_{data_type} "
-                       f"WHERE messstelle_nr = '{selected_station_id}'")
-        data_pegel = pd.read_sql(query_pegel, connection_pegel)
-        connection_pegel.close()
+        # Use the precomputed figure if available, otherwise compute and store it
+        fig = precompute.load_result('figure', selected_station_id, data_type)
+        if fig is None:
+            fig = precompute.compute_figure(selected_station_id, station_name, data_type)
 
-        y_axis_name = 'Durchfluss in m³/s' if data_type == 'q' else 'Wasserstand in cm'
-
-        fig = go.Figure()
-        fig.add_trace(
-            go.Scatter(x=data_pegel['zeit'], y=data_pegel[data_type], mode='lines+markers', name=station_name))
-        fig.update_layout(title=f'Zeitreihe für {station_name}',
-                          xaxis_title='Zeit',
-                          yaxis_title=y_axis_name)
-
-        return fig
+        return json.loads(fig)
     else:
         return {}
 
@@ -429,32 +429,13 @@ def update_statistic(clickData, data_type):
         selected_data = data[data['Standort'] == station]
         selected_station = selected_data['messstelle_nr'].values[0]
 
-        # Connect to the SQLite database
-        connection_pegel = sqlite3.connect('Geo_406_Schmitt.db')
-
-        query_pegel = (f"SELECT messstelle_nr, zeit, {data_type} FROM pegel_{data_type} "
-                       f"WHERE messstelle_nr = '{selected_station}'")
-        data_pegel = pd.read_sql(query_pegel, connection_pegel)
-        connection_pegel.close()
-
-        mean = round(data_pegel[data_type].mean(), 3)
-        max_value = data_pegel[data_type].max()
-        min_value = data_pegel[data_type].min()
-        std = round(data_pegel[data_type].std(), 3)
-        q25 = round(data_pegel[data_type].quantile(0.25), 3)
-        q50 = round(data_pegel[data_type].quantile(0.5), 3)
-        q75 = round(data_pegel[data_type].quantile(0.75), 3)
+        # Use the precomputed statistics if available, otherwise compute and store them
+        statistic = precompute.load_result('statistic', selected_station, data_type)
+        if statistic is None:
+            statistic = precompute.compute_statistic(selected_station, data_type)
 
         statistic_table = dash_table.DataTable(
-            data=[
-                {'Statistic': 'Mean', 'Value': mean},
-                {'Statistic': 'Max', 'Value': max_value},
-                {'Statistic': 'Min', 'Value': min_value},
-                {'Statistic': 'Std', 'Value': std},
-                {'Statistic': '25%', 'Value': q25},
-                {'Statistic': '50%', 'Value': q50},
-                {'Statistic': '75%', 'Value': q75}
-            ],
+            data=json.loads(statistic),
             columns=[
                 {'name': 'Statistik', 'id': 'Statistic'},
                 {'name': 'Wert', 'id': 'Value'}
@@ -472,13 +453,19 @@ def update_statistic(clickData, data_type):
     Output("download-dataframe-csv", "data"),
     [Input("btn_csv", "n_clicks")],
     [State('map', 'clickData')],
-    [State("data-type", "value")]
+    [State("data-type", "value")],
+    background=True,
+    running=[(Output("btn_csv", "disabled"), True, False)],
+    progress=[Output("download-progress", "value"), Output("download-progress", "max")],
+    prevent_initial_call=True
 )
-def download_data(n_clicks, clickData, data_type):
+def download_data(set_progress, n_clicks, clickData, data_type):
     """
     Download the data as a CSV file based on the clicked data point and selected data type.
+    Runs as background task and reports the progress to the progress bar.
 
     Args:
+        set_progress (callable): Function to report the progress as (value, max).
         n_clicks (int): Number of times the download button has been clicked.
         clickData (dict): Data representing the clicked point on the map.
         data_type (str): The type of data for which CSV is generated (e.g., 'q' for flow, 'w' for water level).
@@ -488,21 +475,29 @@ def download_data(n_clicks, clickData, data_type):
     """
     if clickData and n_clicks:
         mess_id = clickData['points'][0]['customdata'][0]
-
-        # Connect to the SQLite database inside the callback
-        connection_download = sqlite3.connect('Geo_406_Schmitt.db')
-        cursor_download = connection_download.cursor()
-        # Construct and execute the SQL query
-        query_meta = f"SELECT * FROM pegel_{data_type} WHERE messstelle_nr = '{mess_id}' "
-        cursor_download.execute(query_meta)
-        data_download = cursor_download.fetchall()
-        connection_download.close()
-        download_df = pd.DataFrame(data_download, columns=['messstelle_nr', 'zeit', data_type,
-                                                           f'{data_type}_min', f'{data_type}_max'])
-
-        return dcc.send_data_frame(download_df.to_csv, f"{mess_id}_{data_type}.csv")
+        set_progress((0, 3))
+
+        # Use the precomputed export file if available, otherwise write and store it
+        file = precompute.load_result('export', mess_id, data_type)
+        download = None
+        if file is not None:
+            try:
+                download = dcc.send_file(file, f"{mess_id}_{data_type}.csv")
+            except FileNotFoundError:
+                # The export file was removed meanwhile (e.g. by an ingest)
+                download = None
+        if download is None:
+            file = precompute.compute_export(mess_id, data_type, set_progress=set_progress)
+            download = dcc.send_file(file, f"{mess_id}_{data_type}.csv")
+        set_progress((3, 3))
+
+        return download
     return None
 
 
-# Run the Flask app
-app.run(debug=False, port=5000)
+if __name__ == '__main__':
+    # Warm the result store for the most requested stations in the background
+    precompute.submit_warm_up()
+
+    # Run the Flask app
+    app.run(debug=False, port=5000)
@@ -2,6 +2,7 @@ import pathlib
 import pandas as pd
 import sqlite3
 import csv
+import precompute
 
 # setup paths
 current_directory = pathlib.Path(__file__).parent
@@ -158,3 +159,6 @@ for file in w_files:
 # Process metadata
 read_meta_data(str(meta_data_path), conn, curs)
 conn.close()
+
+# Precompute figures, statistics and exports of the most requested stations
+precompute.refresh_cache(path=db_path)
@@ -0,0 +1,352 @@
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+import pandas as pd
+import plotly.graph_objs as go
+
+# setup paths
+current_directory = pathlib.Path(__file__).parent
+db_path = current_directory / 'Geo_406_Schmitt.db'
+export_path = current_directory / 'exports'
+
+# Number of stations which are precomputed after each ingest
+top_stations = 10
+
+# Background job queue for the precomputation jobs
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+def connect(path=db_path):
+    """
+    Opens a new connection to the database. Every job uses its own connection,
+    because SQLite connections must not be shared between threads.
+
+    Args:
+        path (str): The path to the database file.
+
+    Returns:
+        sqlite3.Connection: A connection object to the database.
+    """
+    return sqlite3.connect(path, timeout=30)
+
+
+def create_cache_tables(connection, cursor):
+    """
+    Creates the result store and the request counter tables if they don't already exist.
+
+    Args:
+        connection: A connection object to the database.
+        cursor: A cursor object for executing SQL commands.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS result_cache(
+        kind TEXT,
+        messstelle_nr TEXT,
+        data_type TEXT,
+        payload TEXT,
+        erstellt TEXT,
+        PRIMARY KEY (kind, messstelle_nr, data_type)
+        )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS station_requests(
+        messstelle_nr TEXT,
+        data_type TEXT,
+        anzahl INTEGER,
+        PRIMARY KEY (messstelle_nr, data_type)
+        )''')
+    connection.commit()
+
+
+def init_cache(path=db_path):
+    """
+    Creates the result store and the request counter tables in the database file of the worker.
+
+    Args:
+        path (str): The path to the database file.
+    """
+    connection = connect(path)
+    create_cache_tables(connection, connection.cursor())
+    connection.close()
+
+
+def clear_cache(connection, cursor):
+    """
+    Clears all precomputed results and removes the exported files.
+    The request counters are kept, so the most requested stations are known after an ingest.
+
+    Args:
+        connection: A connection object to the database.
+        cursor: A cursor object for executing SQL commands.
+    """
+    cursor.execute('''DELETE FROM result_cache''')
+    connection.commit()
+    if export_path.exists():
+        for file in export_path.glob('*.csv'):
+            file.unlink()
+
+
+def count_request(station_id, data_type, path=db_path):
+    """
+    Increases the request counter of a station and data type.
+
+    Args:
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+    """
+    try:
+        connection = connect(path)
+        connection.execute('''
+            INSERT INTO station_requests (messstelle_nr, data_type, anzahl) VALUES (?, ?, 1)
+            ON CONFLICT (messstelle_nr, data_type) DO UPDATE SET anzahl = anzahl + 1
+        ''', (str(station_id), data_type))
+        connection.commit()
+        connection.close()
+    except Exception as e:
+        print(f"Error counting request {station_id}_{data_type}: {e}")
+
+
+def load_result(kind, station_id, data_type, path=db_path):
+    """
+    Loads a precomputed result from the result store.
+
+    Args:
+        kind (str): The kind of the result ('figure', 'statistic' or 'export').
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+
+    Returns:
+        str: The stored payload, or None if the result was not precomputed yet.
+    """
+    connection = connect(path)
+    row = connection.execute('SELECT payload FROM result_cache WHERE kind = ? AND messstelle_nr = ? AND data_type = ?',
+                             (kind, str(station_id), data_type)).fetchone()
+    connection.close()
+    return row[0] if row else None
+
+
+def store_result(kind, station_id, data_type, payload, path=db_path):
+    """
+    Stores a computed result in the result store.
+
+    Args:
+        kind (str): The kind of the result ('figure', 'statistic' or 'export').
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        payload (str): The serialized result.
+        path (str): The path to the database file.
+    """
+    connection = connect(path)
+    connection.execute('INSERT OR REPLACE INTO result_cache (kind, messstelle_nr, data_type, payload, erstellt) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (kind, str(station_id), data_type, payload, datetime.now().isoformat()))
+    connection.commit()
+    connection.close()
+
+
+def read_pegel(station_id, data_type, path=db_path):
+    """
+    Reads the time series of a station from the database.
+
+    Args:
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+
+    Returns:
+        DataFrame: The time series with the columns messstelle_nr, zeit, value, min and max.
+    """
+    connection = connect(path)
+    query_pegel = f"SELECT * FROM pegel_{data_type} WHERE messstelle_nr = ?"
+    data_pegel = pd.read_sql(query_pegel, connection, params=(str(station_id),))
+    connection.close()
+    return data_pegel
+
+
+def compute_figure(station_id, station_name, data_type, path=db_path):
+    """
+    Computes the time series plot of a station and stores it as figure JSON.
+
+    Args:
+        station_id (str): The ID of the station.
+        station_name (str): The name of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+
+    Returns:
+        str: The Plotly figure as JSON.
+    """
+    data_pegel = read_pegel(station_id, data_type, path)
+
+    y_axis_name = 'Durchfluss in m³/s' if data_type == 'q' else 'Wasserstand in cm'
+
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scatter(x=data_pegel['zeit'], y=data_pegel[data_type], mode='lines+markers', name=station_name))
+    fig.update_layout(title=f'Zeitreihe für {station_name}',
+                      xaxis_title='Zeit',
+                      yaxis_title=y_axis_name)
+
+    payload = fig.to_json()
+    store_result('figure', station_id, data_type, payload, path)
+    return payload
+
+
+def compute_statistic(station_id, data_type, path=db_path):
+    """
+    Computes the statistics of a station and stores them as JSON.
+
+    Args:
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+
+    Returns:
+        str: The rows of the statistic table as JSON.
+    """
+    data_pegel = read_pegel(station_id, data_type, path)
+
+    mean = round(data_pegel[data_type].mean(), 3)
+    max_value = data_pegel[data_type].max()
+    min_value = data_pegel[data_type].min()
+    std = round(data_pegel[data_type].std(), 3)
+    q25 = round(data_pegel[data_type].quantile(0.25), 3)
+    q50 = round(data_pegel[data_type].quantile(0.5), 3)
+    q75 = round(data_pegel[data_type].quantile(0.75), 3)
+
+    rows = [
+        {'Statistic': 'Mean', 'Value': mean},
+        {'Statistic': 'Max', 'Value': max_value},
+        {'Statistic': 'Min', 'Value': min_value},
+        {'Statistic': 'Std', 'Value': std},
+        {'Statistic': '25%', 'Value': q25},
+        {'Statistic': '50%', 'Value': q50},
+        {'Statistic': '75%', 'Value': q75}
+    ]
+
+    # numpy values are not JSON serializable, NaN is stored as null
+    payload = json.dumps([{'Statistic': row['Statistic'],
+                           'Value': None if pd.isna(row['Value']) else float(row['Value'])} for row in rows])
+    store_result('statistic', station_id, data_type, payload, path)
+    return payload
+
+
+def compute_export(station_id, data_type, path=db_path, set_progress=None):
+    """
+    Writes the time series of a station to a CSV file and stores the file path.
+    The file is written to a temporary file first and then moved into place,
+    so readers never see a partly written export.
+
+    Args:
+        station_id (str): The ID of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+        set_progress (callable): Optional function which reports the progress as (step, steps).
+                                 The completion is reported by the caller.
+
+    Returns:
+        str: The path to the CSV file.
+    """
+    if set_progress:
+        set_progress((1, 3))
+    data_download = read_pegel(station_id, data_type, path)
+
+    if set_progress:
+        set_progress((2, 3))
+    export_path.mkdir(exist_ok=True)
+    file = export_path / f"{station_id}_{data_type}.csv"
+    with tempfile.NamedTemporaryFile('w', dir=export_path, suffix='.tmp', delete=False, newline='') as temp_file:
+        data_download.to_csv(temp_file)
+    os.replace(temp_file.name, file)
+
+    store_result('export', station_id, data_type, str(file), path)
+    return str(file)
+
+
+def most_requested_stations(number=top_stations, path=db_path):
+    """
+    Returns the most requested pairs of station and data type. If no requests were counted yet,
+    the first stations of the metadata table are returned.
+
+    Args:
+        number (int): The number of (station, data type) pairs.
+        path (str): The path to the database file.
+
+    Returns:
+        list: A list of tuples (messstelle_nr, Standort, data_type).
+    """
+    connection = connect(path)
+    stations = connection.execute('''
+        SELECT r.messstelle_nr, m.Standort, r.data_type FROM station_requests r
+        JOIN pegel_meta m ON CAST(m.messstelle_nr AS TEXT) = r.messstelle_nr
+        ORDER BY r.anzahl DESC LIMIT ?
+    ''', (number,)).fetchall()
+
+    if not stations:
+        meta = connection.execute('SELECT messstelle_nr, Standort FROM pegel_meta LIMIT ?', (number,)).fetchall()
+        stations = [(str(station_id), name, data_type)
+                    for station_id, name in meta for data_type in ('q', 'w')][:number]
+    connection.close()
+    return stations
+
+
+def warm_station(station_id, station_name, data_type, path=db_path, force=False):
+    """
+    Precomputes the figure, the statistics and the export file of a station.
+    Results which are already stored are skipped unless force is set.
+
+    Args:
+        station_id (str): The ID of the station.
+        station_name (str): The name of the station.
+        data_type (str): The type of data ('q' or 'w').
+        path (str): The path to the database file.
+        force (bool): Recompute all results, even if they are already stored.
+    """
+    try:
+        if force or load_result('figure', station_id, data_type, path) is None:
+            compute_figure(station_id, station_name, data_type, path)
+        if force or load_result('statistic', station_id, data_type, path) is None:
+            compute_statistic(station_id, data_type, path)
+        file = load_result('export', station_id, data_type, path)
+        if force or file is None or not pathlib.Path(file).exists():
+            compute_export(station_id, data_type, path)
+    except Exception as e:
+        print(f"Error precomputing {station_id}_{data_type}: {e}")
+
+
+def submit_warm_up(number=top_stations, path=db_path, force=False):
+    """
+    Submits precomputation jobs for the most requested stations to the background job queue.
+
+    Args:
+        number (int): The number of (station, data type) pairs.
+        path (str): The path to the database file.
+        force (bool): Recompute all results, even if they are already stored.
+
+    Returns:
+        list: The futures of the submitted jobs.
+    """
+    return [executor.submit(warm_station, station_id, station_name, data_type, path, force)
+            for station_id, station_name, data_type in most_requested_stations(number, path)]
+
+
+def refresh_cache(number=top_stations, path=db_path):
+    """
+    Clears the outdated results after an ingest and rebuilds the most requested stations.
+    Waits until all jobs are finished.
+
+    Args:
+        number (int): The number of (station, data type) pairs.
+        path (str): The path to the database file.
+    """
+    connection = connect(path)
+    cursor = connection.cursor()
+    create_cache_tables(connection, cursor)
+    clear_cache(connection, cursor)
+    connection.close()
+
+    wait(submit_warm_up(number, path, force=True))